@@ -6,13 +6,15 @@ import math
 import csv
 import copy
 
+from collections import Counter
+from datetime import datetime, timezone
 from pathlib import Path
 from abc import ABC, abstractmethod
 
 import common.config_manager as config
 from common.lib.dataset import DataSet
 from backend.abstract.processor import BasicProcessor
-from common.lib.helpers import strip_tags, dict_search_and_update, remove_nuls
+from common.lib.helpers import strip_tags, dict_search_and_update, remove_nuls, batched
 from common.lib.exceptions import WorkerInterruptedException, ProcessorInterruptedException
 
 
@@ -48,6 +50,20 @@ class Search(BasicProcessor, ABC):
 	# Mandatory columns: ['thread_id', 'body', 'subject', 'timestamp']
 	return_cols = ['thread_id', 'body', 'subject', 'timestamp']
 
+	#: Comma-separated `return_cols`, for use in SQL queries. Set
+	#: automatically for each descending class.
+	sql_columns = ", ".join(return_cols)
+
+	def __init_subclass__(cls, **kwargs):
+		"""
+		Prepare SQL fragments for descending classes
+
+		These only depend on class attributes, so they can be built once when
+		the class is defined instead of for every query.
+		"""
+		super().__init_subclass__(**kwargs)
+		cls.sql_columns = ", ".join(cls.return_cols)
+
 	def process(self):
 		"""
 		Create 4CAT dataset from a data source
@@ -59,13 +75,16 @@ class Search(BasicProcessor, ABC):
 
 		query_parameters = self.dataset.get_parameters()
 		results_file = self.dataset.get_results_path()
+		import_file = query_parameters.get("file")
+		next_processors = query_parameters.get("next", [])
+		copy_to = query_parameters.get("copy_to")
 
 		self.log.info("Querying: %s" % str({k: v for k, v in query_parameters.items() if not self.get_options().get(k, {}).get("sensitive", False)}))
 
 		# Execute the relevant query (string-based, random, countryflag-based)
 		try:
-			if query_parameters.get("file"):
-				items = self.import_from_file(query_parameters.get("file"))
+			if import_file:
+				items = self.import_from_file(import_file)
 			else:
 				items = self.search(query_parameters)
 
@@ -83,13 +102,18 @@ class Search(BasicProcessor, ABC):
 			else:
 				raise NotImplementedError("Datasource query cannot be saved as %s file" % results_file.suffix)
 
-			self.dataset.update_status("Query finished, results are available.")
+			# items may be a generator, in which case we only know if there
+			# were any after writing them
+			if num_items > 0:
+				self.dataset.update_status("Query finished, results are available.")
+			else:
+				self.dataset.update_status("Query finished, no results found.")
 		elif items is not None:
 			self.dataset.update_status("Query finished, no results found.")
 
 		# queue predefined processors
-		if num_items > 0 and query_parameters.get("next", []):
-			for next in query_parameters.get("next"):
+		if num_items > 0 and next_processors:
+			for next in next_processors:
 				next_parameters = next.get("parameters", {})
 				next_type = next.get("type", "")
 				available_processors = self.dataset.get_available_processors()
@@ -102,15 +126,15 @@ class Search(BasicProcessor, ABC):
 					self.queue.add_job(next_type, remote_id=next_analysis.key)
 
 		# see if we need to register the result somewhere
-		if query_parameters.get("copy_to", None):
+		if copy_to:
 			# copy the results to an arbitrary place that was passed
-			if self.dataset.get_results_path().exists():
+			if results_file.exists():
 				# but only if we actually have something to copy
-				shutil.copyfile(str(self.dataset.get_results_path()), query_parameters.get("copy_to"))
+				shutil.copyfile(str(results_file), copy_to)
 			else:
 				# if copy_to was passed, that means it's important that this
 				# file exists somewhere, so we create it as an empty file
-				with open(query_parameters.get("copy_to"), "w") as empty_file:
+				with open(copy_to, "w") as empty_file:
 					empty_file.write("")
 
 		self.dataset.finish(num_rows=num_items)
@@ -215,9 +239,11 @@ class Search(BasicProcessor, ABC):
 		# hashes
 		hasher = hashlib.blake2b(digest_size=24)
 		hasher.update(str(config.get('ANONYMISATION_SALT')).encode("utf-8"))
+		check_cache = CheckCache(hash_cache, hasher)
 
 		processed = 0
 		header_written = False
+		author_fields = []
 		with filepath.open("w", encoding="utf-8") as csvfile:
 			# Parsing: remove the HTML tags, but keep the <br> as a newline
 			# Takes around 1.5 times longer
@@ -232,11 +258,14 @@ class Search(BasicProcessor, ABC):
 					writer.writeheader()
 					header_written = True
 
+					# all rows have the same columns, so determine which
+					# columns need to be pseudonymised only once
+					if pseudonymise_author:
+						author_fields = [field for field in row.keys() if "author" in field]
+
 				processed += 1
 
 				# Create human dates from timestamp
-				from datetime import datetime, timezone
-
 				if "timestamp" in row:
 					# Data sources should have "timestamp" as a unix epoch integer,
 					# but do some conversion if this is not the case.
@@ -270,8 +299,6 @@ class Search(BasicProcessor, ABC):
 				# replace author column with salted hash of the author name, if
 				# pseudonymisation is enabled
 				if pseudonymise_author:
-					check_cache = CheckCache(hash_cache, hasher)
-					author_fields = [field for field in row.keys() if "author" in field]
 					for author_field in author_fields:
 						row[author_field] = check_cache.update_cache(row[author_field])
 
@@ -358,6 +385,10 @@ class SearchWithScope(Search, ABC):
 	- All items in a thread containing at least x% matching items
 	"""
 
+	#: Amount of threads to fetch items for at a time when expanding the
+	#: search scope to full threads
+	thread_batch_size = 500
+
 	def search(self, query):
 		"""
 		Complex search
@@ -384,68 +415,39 @@ class SearchWithScope(Search, ABC):
 		if query.get("search_scope", None) == "dense-threads":
 			# dense threads - all items in all threads in which the requested
 			# proportion of items matches
-			# first, get amount of items for all threads in which matching
-			# items occur and that are long enough
-			thread_ids = tuple([post["thread_id"] for post in items])
-			self.dataset.update_status("Retrieving thread metadata for %i threads" % len(thread_ids))
+			# first, determine how many matching items occur per thread in
+			# the initial data set. items may be a generator, so this is done
+			# in a single pass
+			items_per_thread = Counter(item["thread_id"] for item in items)
+
+			# then keep all thread IDs where that amount is more than the
+			# requested density, for threads that are long enough
+			self.dataset.update_status("Retrieving thread metadata for %i threads" % len(items_per_thread))
 			try:
 				min_length = int(query.get("scope_length", 30))
 			except ValueError:
 				min_length = 30
 
-			thread_sizes = self.get_thread_sizes(thread_ids, min_length)
-
-			# determine how many matching items occur per thread in the initial
-			# data set
-			items_per_thread = {}
-			for item in items:
-				if item["thread_id"] not in items_per_thread:
-					items_per_thread[item["thread_id"]] = 0
-
-				items_per_thread[item["thread_id"]] += 1
-
-			# keep all thread IDs where that amount is more than the requested
-			# density
-			qualifying_thread_ids = set()
-
-			self.dataset.update_status("Filtering dense threads")
 			try:
 				percentage = int(query.get("scope_density")) / 100
 			except (ValueError, TypeError):
 				percentage = 0.15
 
-			for thread_id in items_per_thread:
-				if thread_id not in thread_sizes:
-					# thread not long enough
-					continue
-				required_items = math.ceil(percentage * thread_sizes[thread_id])
-				if items_per_thread[thread_id] >= required_items:
-					qualifying_thread_ids.add(thread_id)
-
-			if len(qualifying_thread_ids) > 25000:
-				self.dataset.update_status(
-					"Too many matching threads (%i) to get full thread data for, aborting. Please try again with a narrower query." % len(
-						qualifying_thread_ids))
-				return None
+			self.dataset.update_status("Filtering dense threads")
+			qualifying_thread_ids = self.get_dense_thread_ids(items_per_thread, min_length, percentage)
 
 			if qualifying_thread_ids:
 				self.dataset.update_status("Fetching all items in %i threads" % len(qualifying_thread_ids))
-				items = self.fetch_threads(tuple(qualifying_thread_ids))
+				items = self.fetch_threads_batched(qualifying_thread_ids)
 			else:
 				self.dataset.update_status("No threads matched the full thread search parameters.")
 				return None
 
 		elif query.get("search_scope", None) == "full-threads":
 			# get all items in threads containing at least one matching item
-			thread_ids = tuple(set([item["thread_id"] for item in items]))
-			if len(thread_ids) > 25000:
-				self.dataset.update_status(
-					"Too many matching threads (%i) to get full thread data for, aborting. Please try again with a narrower query." % len(
-						thread_ids))
-				return None
-
+			thread_ids = set([item["thread_id"] for item in items])
 			self.dataset.update_status("Retrieving all items from %i threads" % len(thread_ids))
-			items = self.fetch_threads(thread_ids)
+			items = self.fetch_threads_batched(thread_ids)
 
 		elif mode == "complex":
 			# create a random sample subset of all items if requested. for
@@ -455,9 +457,20 @@ class SearchWithScope(Search, ABC):
 				try:
 					self.dataset.update_status("Creating random sample")
 					sample_size = int(query.get("sample_size", 5000))
-					items = list(items)
-					random.shuffle(items)
-					return items[0:sample_size]
+
+					# reservoir sampling, so only the sample needs to be kept
+					# in memory rather than all items
+					sample = []
+					for i, item in enumerate(items):
+						if i < sample_size:
+							sample.append(item)
+						else:
+							replace = random.randint(0, i)
+							if replace < sample_size:
+								sample[replace] = item
+
+					random.shuffle(sample)
+					return sample
 				except ValueError:
 					pass
 
@@ -468,6 +481,21 @@ class SearchWithScope(Search, ABC):
 
 		return items
 
+	def fetch_threads_batched(self, thread_ids):
+		"""
+		Get items for given thread IDs, a batch of threads at a time
+
+		Threads can be long, so fetching all items for many threads at once
+		can take up a lot of memory. Instead, `fetch_threads()` is called for
+		`thread_batch_size` threads at a time, and items are yielded as they
+		are fetched. Threads are fetched in order of their ID.
+
+		:param Iterable thread_ids:  Thread IDs to fetch items for
+		:return Generator:  Yields items
+		"""
+		for batch in batched(sorted(thread_ids), self.thread_batch_size):
+			yield from self.fetch_threads(batch)
+
 	def get_items(self, query):
 		"""
 		Not available in this subclass
@@ -540,6 +568,36 @@ class SearchWithScope(Search, ABC):
 		"""
 		pass
 
+	def get_dense_thread_ids(self, items_per_thread, min_length, density):
+		"""
+		Get IDs of threads in which enough items match
+
+		By default, this gets the thread sizes via `get_thread_sizes()` and
+		compares them to the amount of matching items. Descending classes may
+		override this to do the comparison in one go, e.g. with a single
+		database query.
+
+		:param dict items_per_thread:  Amount of matching items, with thread
+		IDs as keys
+		:param int min_length:  Min length for a thread to be included in the
+		results
+		:param float density:  Proportion of items in a thread that need to
+		match, between 0 and 1
+		:return set:  IDs of qualifying threads
+		"""
+		thread_sizes = self.get_thread_sizes(tuple(items_per_thread.keys()), min_length)
+
+		qualifying_thread_ids = set()
+		for thread_id in items_per_thread:
+			if thread_id not in thread_sizes:
+				# thread not long enough
+				continue
+			required_items = math.ceil(density * thread_sizes[thread_id])
+			if items_per_thread[thread_id] >= required_items:
+				qualifying_thread_ids.add(thread_id)
+
+		return qualifying_thread_ids
+
 	@abstractmethod
 	def get_thread_sizes(self, thread_ids, min_length):
 		"""
@@ -4,6 +4,8 @@ Restart 4CAT and optionally upgrade it to the latest release
 import subprocess
 import requests
 import hashlib
+import select
+import shutil
 import shlex
 import json
 import time
@@ -42,6 +44,14 @@ class FourcatRestarterAndUpgrader(BasicWorker):
     type = "restart-4cat"
     max_workers = 1
 
+    # pipe that is written to when an interrupt is requested, so waiting for
+    # the restart process can be interrupted without polling
+    interrupt_pipe = None
+
+    # buffer size for writing to the restart log; the log is flushed
+    # explicitly when its contents need to be visible to the front-end
+    log_buffer_size = 64 * 1024
+
     def work(self):
         """
         Restart 4CAT and optionally upgrade it to the latest release
@@ -58,163 +68,224 @@ class FourcatRestarterAndUpgrader(BasicWorker):
         # this file has the log of the restart worker itself and is checked by
         # the frontend to see how far we are
         log_file_restart = Path(config.get("PATH_ROOT"), config.get("PATH_LOGS"), "restart.log")
-        log_stream_restart = log_file_restart.open("a")
-
-        if not is_resuming:
-            log_stream_restart.write("Initiating 4CAT restart worker\n")
-            self.log.info("New restart initiated.")
-
-            # this lock file will ensure that people don't start two
-            # simultaneous upgrades or something
-            with lock_file.open("w") as outfile:
-                hasher = hashlib.blake2b()
-                hasher.update(str(uuid.uuid4()).encode("utf-8"))
-                outfile.write(hasher.hexdigest())
-
-            # trigger a restart and/or upgrade
-            # returns a JSON with a 'status' key and a message, the message
-            # being the process output
-            if log_file_backend.exists():
-                log_file_backend.unlink()
-
-            if self.job.data["remote_id"] == "upgrade":
-                command = sys.executable + " helper-scripts/migrate.py --release --repository %s --yes --restart --output %s" % \
-                          (shlex.quote(config.get("4cat.github_url")), shlex.quote(str(log_file_backend)))
-            else:
-                command = sys.executable + " 4cat-daemon.py --no-version-check force-restart"
+        log_stream_restart = log_file_restart.open("a", buffering=self.log_buffer_size)
+
+        try:
+            if not is_resuming:
+                log_stream_restart.write("Initiating 4CAT restart worker\n")
+                self.log.info("New restart initiated.")
+
+                # this lock file will ensure that people don't start two
+                # simultaneous upgrades or something
+                with lock_file.open("w") as outfile:
+                    hasher = hashlib.blake2b()
+                    hasher.update(str(uuid.uuid4()).encode("utf-8"))
+                    outfile.write(hasher.hexdigest())
+
+                # trigger a restart and/or upgrade
+                # returns a JSON with a 'status' key and a message, the message
+                # being the process output
+                if log_file_backend.exists():
+                    log_file_backend.unlink()
+
+                if self.job.data["remote_id"] == "upgrade":
+                    command = sys.executable + " helper-scripts/migrate.py --release --repository %s --yes --restart --output %s" % \
+                              (shlex.quote(config.get("4cat.github_url")), shlex.quote(str(log_file_backend)))
+                else:
+                    command = sys.executable + " 4cat-daemon.py --no-version-check force-restart"
+
+                try:
+                    # the tricky part is that this command will interrupt the
+                    # daemon, i.e. this worker!
+                    # so we'll never get to actually send a response, if all goes
+                    # well. but the file descriptor that stdout is piped to remains
+                    # open, somehow, so we can use that to keep track of the output
+                    # stdin needs to be /dev/null here because else when 4CAT
+                    # restarts and we re-attempt to make a daemon, it will fail
+                    # when trying to close the stdin file descriptor of the
+                    # subprocess (man, that was a fun bug to hunt down)
+                    log_stream_backend = log_file_backend.open("a")
+                    self.log.info("Running command %s" % command)
+                    process = subprocess.Popen(shlex.split(command), cwd=config.get("PATH_ROOT"),
+                                               stdout=log_stream_backend, stderr=log_stream_backend, stdin=subprocess.DEVNULL)
 
-            try:
-                # the tricky part is that this command will interrupt the
-                # daemon, i.e. this worker!
-                # so we'll never get to actually send a response, if all goes
-                # well. but the file descriptor that stdout is piped to remains
-                # open, somehow, so we can use that to keep track of the output
-                # stdin needs to be /dev/null here because else when 4CAT
-                # restarts and we re-attempt to make a daemon, it will fail
-                # when trying to close the stdin file descriptor of the
-                # subprocess (man, that was a fun bug to hunt down)
-                log_stream_backend = log_file_backend.open("a")
-                self.log.info("Running command %s" % command)
-                process = subprocess.Popen(shlex.split(command), cwd=config.get("PATH_ROOT"),
-                                           stdout=log_stream_backend, stderr=log_stream_backend, stdin=subprocess.DEVNULL)
-
-                while not self.interrupted:
                     # basically wait for either the process to quit or 4CAT to
                     # be restarted (hopefully the latter)
-                    try:
-                        process.wait(1)
+                    log_stream_restart.flush()
+                    self.wait_for_process(process)
+
+                    if process.returncode is not None:
                         log_stream_backend.close()
-                        break
-                    except subprocess.TimeoutExpired:
+                        # if we reach this, 4CAT was never restarted, and so the job failed
+                        log_stream_restart.write("\nUnexpected outcome of restart call (%s).\n" % (repr(process.returncode)))
+
+                        raise RuntimeError()
+                    else:
+                        # interrupted before the process could finish (as it should)
+                        self.log.info("Restart triggered. Restarting 4CAT.\n")
+                        raise WorkerInterruptedException()
+
+                except (RuntimeError, subprocess.CalledProcessError) as e:
+                    log_stream_restart.write(str(e) + "\n")
+                    log_stream_restart.write("[Worker] Error while restarting 4CAT. The script returned a non-standard error code "
+                                     "(see above). You may need to restart 4CAT manually.\n")
+                    self.log.error("Error restarting 4CAT. See %s for details." % log_stream_restart.name)
+                    lock_file.unlink()
+                    self.job.finish()
+
+            else:
+                # 4CAT back-end was restarted - now check the results and make the
+                # front-end restart or upgrade too
+                self.log.info("Restart worker resumed after restarting 4CAT, restart successful.")
+                log_stream_restart.write("4CAT restarted.\n")
+                with Path(config.get("PATH_ROOT"), "config/.current-version").open() as infile:
+                    log_stream_restart.write("4CAT is now running version %s.\n" % infile.readline().strip())
+
+                if log_file_backend.exists():
+                    # copy output of started process to restart log
+                    with log_file_backend.open() as infile:
+                        shutil.copyfileobj(infile, log_stream_restart, 64 * 1024)
+                        log_stream_restart.write("\n")
+
+                    log_file_backend.unlink()
+
+                # we're gonna use some specific Flask routes to trigger this, i.e.
+                # we're interacting with the front-end through HTTP
+                api_host = "https://" if config.get("flask.https") else "http://"
+                api_host += "4cat_frontend:5000" if config.get("USING_DOCKER") else config.get("flask.server_name")
+
+                if self.job.data["remote_id"] == "upgrade" and config.get("USING_DOCKER"):
+                    # when using Docker, the front-end needs to update separately
+                    log_stream_restart.write("Telling front-end Docker container to upgrade...\n")
+                    log_stream_restart.close()  # close, because front-end will be writing to it
+                    upgrade_ok = False
+                    upgrade_timeout = False
+                    try:
+                        upgrade_url = api_host + "/admin/trigger-frontend-upgrade/"
+                        with lock_file.open() as infile:
+                            frontend_upgrade = requests.post(upgrade_url, data={"token": infile.read()}, timeout=(10 * 60))
+                        upgrade_ok = frontend_upgrade.json()["status"] == "OK"
+                    except requests.RequestException:
                         pass
+                    except TimeoutError:
+                        upgrade_timeout = True
+
+                    log_stream_restart = log_file_restart.open("a", buffering=self.log_buffer_size)
+                    if not upgrade_ok:
+                        if upgrade_timeout:
+                            log_stream_restart.write("Upgrade timed out.")
+                        log_stream_restart.write("Error upgrading front-end container. You may need to upgrade and restart"
+                                                 "containers manually.\n")
+                        lock_file.unlink()
+                        return self.job.finish()
+
+                # restart front-end
+                log_stream_restart.write("Asking front-end to restart itself...\n")
+                log_stream_restart.flush()
+                try:
+                    restart_url = api_host + "/admin/trigger-frontend-restart/"
+                    with lock_file.open() as infile:
+                        response = requests.post(restart_url, data={"token": infile.read()}, timeout=5).json()
 
-                if process.returncode is not None:
-                    # if we reach this, 4CAT was never restarted, and so the job failed
-                    log_stream_restart.write("\nUnexpected outcome of restart call (%s).\n" % (repr(process.returncode)))
+                    if response.get("message"):
+                        log_stream_restart.write(response.get("message") + "\n")
+                except (json.JSONDecodeError, requests.RequestException):
+                    # this may happen because the server restarts and interrupts
+                    # the request
+                    pass
+
+                # wait for front-end to come online after a restart
+                time.sleep(3)  # give some time for the restart to trigger
+                start_time = time.time()
+                frontend_ok = False
+                while time.time() < start_time + 60:
+                    try:
+                        frontend = requests.get(api_host + "/", timeout=5)
+                        if frontend.status_code != 200:
+                            time.sleep(2)
+                            continue
+                        frontend_ok = True
+                        break
+                    except requests.RequestException as e:
+                        time.sleep(1)
+                        continue
 
-                    raise RuntimeError()
+                # too bad
+                if not frontend_ok:
+                    log_stream_restart.write("Timed out waiting for front-end to restart. You may need to restart it "
+                                             "manually.\n")
+                    self.log.error("Front-end did not come back online after restart")
                 else:
-                    # interrupted before the process could finish (as it should)
-                    self.log.info("Restart triggered. Restarting 4CAT.\n")
-                    raise WorkerInterruptedException()
-
-            except (RuntimeError, subprocess.CalledProcessError) as e:
-                log_stream_restart.write(str(e))
-                log_stream_restart.write("[Worker] Error while restarting 4CAT. The script returned a non-standard error code "
-                                 "(see above). You may need to restart 4CAT manually.\n")
-                self.log.error("Error restarting 4CAT. See %s for details." % log_stream_restart.name)
+                    log_stream_restart.write("Front-end is available. Restart complete.")
+                    self.log.info("Front-end is available. Restart complete.")
+
+                log_stream_restart.close()
                 lock_file.unlink()
+
                 self.job.finish()
+        finally:
+            # make sure the log file is closed, even if something unexpected
+            # went wrong
+            log_stream_restart.close()
 
-            finally:
-                log_stream_restart.close()
+    def wait_for_process(self, process):
+        """
+        Wait until a process has ended or the worker is interrupted
 
-        else:
-            # 4CAT back-end was restarted - now check the results and make the
-            # front-end restart or upgrade too
-            self.log.info("Restart worker resumed after restarting 4CAT, restart successful.")
-            log_stream_restart.write("4CAT restarted.\n")
-            with Path(config.get("PATH_ROOT"), "config/.current-version").open() as infile:
-                log_stream_restart.write("4CAT is now running version %s.\n" % infile.readline().strip())
-
-            if log_file_backend.exists():
-                # copy output of started process to restart log
-                with log_file_backend.open() as infile:
-                    log_stream_restart.write(infile.read() + "\n")
-
-                log_file_backend.unlink()
-
-            # we're gonna use some specific Flask routes to trigger this, i.e.
-            # we're interacting with the front-end through HTTP
-            api_host = "https://" if config.get("flask.https") else "http://"
-            api_host += "4cat_frontend:5000" if config.get("USING_DOCKER") else config.get("flask.server_name")
-
-            if self.job.data["remote_id"] == "upgrade" and config.get("USING_DOCKER"):
-                # when using Docker, the front-end needs to update separately
-                log_stream_restart.write("Telling front-end Docker container to upgrade...\n")
-                log_stream_restart.close()  # close, because front-end will be writing to it
-                upgrade_ok = False
-                upgrade_timeout = False
-                try:
-                    upgrade_url = api_host + "/admin/trigger-frontend-upgrade/"
-                    with lock_file.open() as infile:
-                        frontend_upgrade = requests.post(upgrade_url, data={"token": infile.read()}, timeout=(10 * 60))
-                    upgrade_ok = frontend_upgrade.json()["status"] == "OK"
-                except requests.RequestException:
-                    pass
-                except TimeoutError:
-                    upgrade_timeout = True
-
-                log_stream_restart = log_file_restart.open("a")
-                if not upgrade_ok:
-                    if upgrade_timeout:
-                        log_stream_restart.write("Upgrade timed out.")
-                    log_stream_restart.write("Error upgrading front-end container. You may need to upgrade and restart"
-                                             "containers manually.\n")
-                    lock_file.unlink()
-                    return self.job.finish()
+        Where possible (i.e. on Linux 5.3+ with Python 3.9+), this blocks until
+        either happens via a file descriptor for the process and a pipe that is
+        written to when an interrupt is requested. Otherwise, the process is
+        checked once a second.
 
-            # restart front-end
-            log_stream_restart.write("Asking front-end to restart itself...\n")
-            log_stream_restart.flush()
+        :param subprocess.Popen process:  Process to wait for
+        """
+        pidfd = None
+        if hasattr(os, "pidfd_open"):
             try:
-                restart_url = api_host + "/admin/trigger-frontend-restart/"
-                with lock_file.open() as infile:
-                    response = requests.post(restart_url, data={"token": infile.read()}, timeout=5).json()
-
-                if response.get("message"):
-                    log_stream_restart.write(response.get("message") + "\n")
-            except (json.JSONDecodeError, requests.RequestException):
-                # this may happen because the server restarts and interrupts
-                # the request
+                pidfd = os.pidfd_open(process.pid)
+            except OSError:
+                # e.g. unsupported by the kernel, or process already ended
                 pass
 
-            # wait for front-end to come online after a restart
-            time.sleep(3)  # give some time for the restart to trigger
-            start_time = time.time()
-            frontend_ok = False
-            while time.time() < start_time + 60:
+        if pidfd is None:
+            while not self.interrupted:
                 try:
-                    frontend = requests.get(api_host + "/", timeout=5)
-                    if frontend.status_code != 200:
-                        time.sleep(2)
-                        continue
-                    frontend_ok = True
-                    break
-                except requests.RequestException as e:
-                    time.sleep(1)
-                    continue
-
-            # too bad
-            if not frontend_ok:
-                log_stream_restart.write("Timed out waiting for front-end to restart. You may need to restart it "
-                                         "manually.\n")
-                self.log.error("Front-end did not come back online after restart")
-            else:
-                log_stream_restart.write("Front-end is available. Restart complete.")
-                self.log.info("Front-end is available. Restart complete.")
+                    process.wait(1)
+                    return
+                except subprocess.TimeoutExpired:
+                    pass
+            return
+
+        self.interrupt_pipe = os.pipe()
+        try:
+            if not self.interrupted:
+                select.select([pidfd, self.interrupt_pipe[0]], [], [])
+        finally:
+            os.close(pidfd)
+            interrupt_pipe = self.interrupt_pipe
+            self.interrupt_pipe = None
+            for fd in interrupt_pipe:
+                os.close(fd)
+
+        # reap the process if it ended, so its return code is set
+        process.poll()
+
+    def request_interrupt(self, level=1):
+        """
+        Request an abort of this worker
 
-            log_stream_restart.close()
-            lock_file.unlink()
+        This additionally wakes up the worker if it is waiting for the restart
+        process to end.
+
+        :param int level:  Retry or cancel? Either `self.INTERRUPT_RETRY` or
+        `self.INTERRUPT_CANCEL`.
+        """
+        super().request_interrupt(level)
 
-            self.job.finish()
+        interrupt_pipe = self.interrupt_pipe
+        if interrupt_pipe:
+            try:
+                os.write(interrupt_pipe[1], b"\0")
+            except OSError:
+                # pipe was closed in the meantime, i.e. no longer waiting
+                pass
@@ -2,9 +2,11 @@
 Database wrapper
 """
 import itertools
+import logging
 import psycopg2.extras
 import psycopg2
 import time
+import uuid
 
 from psycopg2 import sql
 from psycopg2.extras import execute_values
@@ -60,6 +62,25 @@ class Database:
 
 		self.commit()
 
+	def log_query(self, query, replacements=None, cursor=None):
+		"""
+		Log a query that is about to be executed
+
+		Rendering the query can be expensive for queries with many
+		parameters, so this is only done if debug messages are actually
+		logged.
+
+		:param string query: Query
+		:param replacements: Replacement values
+		:param cursor: Cursor to render the query with. Default - use common
+		cursor
+		"""
+		logger = getattr(self.log, "logger", None)
+		if logger and not logger.isEnabledFor(logging.DEBUG):
+			return
+
+		self.log.debug("Executing query %s" % (cursor or self.cursor).mogrify(query, replacements))
+
 	def query(self, query, replacements=None, cursor=None):
 		"""
 		Execute a query
@@ -72,7 +93,7 @@ class Database:
 		if not cursor:
 			cursor = self.get_cursor()
 
-		self.log.debug("Executing query %s" % self.cursor.mogrify(query, replacements))
+		self.log_query(query, replacements)
 
 		return cursor.execute(query, replacements)
 
@@ -86,7 +107,7 @@ class Database:
 		"""
 		cursor = self.get_cursor()
 
-		self.log.debug("Executing query %s" % self.cursor.mogrify(query, replacements))
+		self.log_query(query, replacements)
 		cursor.execute(query, replacements)
 		self.commit()
 
@@ -138,7 +159,7 @@ class Database:
 		query = sql.SQL(query).format(*identifiers)
 
 		cursor = self.get_cursor()
-		self.log.debug("Executing query: %s" % cursor.mogrify(query, replacements))
+		self.log_query(query, replacements, cursor=cursor)
 		cursor.execute(query, replacements)
 
 		if commit:
@@ -174,7 +195,7 @@ class Database:
 		query = sql.SQL("DELETE FROM {} WHERE " + " AND ".join(where_sql)).format(*identifiers)
 
 		cursor = self.get_cursor()
-		self.log.debug("Executing query: %s" % cursor.mogrify(query, replacements))
+		self.log_query(query, replacements, cursor=cursor)
 		cursor.execute(query, replacements)
 
 		if commit:
@@ -228,7 +249,7 @@ class Database:
 		replacements = (tuple(data.values()),)
 
 		cursor = self.get_cursor()
-		self.log.debug("Executing query: %s" % cursor.mogrify(query, replacements))
+		self.log_query(query, replacements, cursor=cursor)
 		cursor.execute(query, replacements)
 
 		if commit:
@@ -275,7 +296,7 @@ class Database:
 		replacements = (tuple(data.values()),)
 
 		cursor = self.get_cursor()
-		self.log.debug("Executing query: %s" % cursor.mogrify(query, replacements))
+		self.log_query(query, replacements, cursor=cursor)
 		cursor.execute(query, replacements)
 
 		if commit:
@@ -295,7 +316,6 @@ class Database:
 		:return list: The result rows, as a list
 		"""
 		cursor = self.get_cursor()
-		self.log.debug("Executing query: %s" % cursor.mogrify(query, *args))
 		self.query(query, cursor=cursor, *args)
 
 		try:
@@ -332,7 +352,7 @@ class Database:
 
 		return result
 
-	def fetchall_interruptable(self, queue, query, *args):
+	def fetchall_interruptable(self, queue, query, *args, as_tuples=False):
 		"""
 		Fetch all rows for a query, allowing for interruption
 
@@ -353,15 +373,17 @@ class Database:
 		:param str query:  SQL query
 		:param list args:  Replacement variables
 		:param commit:  Commit transaction after query?
-		:return list:  A list of rows, as dictionaries
+		:param bool as_tuples:  Return rows as tuples instead of dictionaries.
+		This is cheaper for queries returning many rows.
+		:return list:  A list of rows, as dictionaries (or tuples)
 		"""
 		# schedule a job that will cancel the query we're about to make
 		pid = self.connection.get_backend_pid()
 		self.interruptable_job = queue.add_job("cancel-pg-query", details={}, remote_id=self.appname, claim_after=time.time() + self.interruptable_timeout)
 
 		# make the query
-		cursor = self.get_cursor()
-		self.log.debug("Executing interruptable query: %s" % cursor.mogrify(query, *args))
+		cursor = self.get_cursor(as_tuples=as_tuples)
+		self.log.debug("Executing interruptable query in connection %s" % self.appname)
 
 		try:
 			self.query(query, cursor=cursor, *args)
@@ -387,6 +409,57 @@ class Database:
 
 		return result
 
+	def fetch_iter(self, query, *args, queue=None, itersize=5000):
+		"""
+		Iterate over the rows for a query, without loading them all at once
+
+		Uses a server-side (named) cursor, so rows are transferred from the
+		database in batches of `itersize` rows as the generator is consumed,
+		instead of all at once. This keeps memory usage flat for queries with
+		large result sets. The cursor is declared `WITH HOLD` so it survives
+		commits made on the same connection while iterating (e.g. status
+		updates).
+
+		If a job queue is passed, the query can be interrupted in the same way
+		as with `fetchall_interruptable()`.
+
+		:param str query:  SQL query
+		:param list args:  Replacement variables
+		:param JobQueue queue:  Optional job queue, to make the query
+		interruptable
+		:param int itersize:  Amount of rows to fetch per round trip
+		:return Generator:  Yields rows, as dictionaries
+		"""
+		if queue:
+			self.interruptable_job = queue.add_job("cancel-pg-query", details={}, remote_id=self.appname, claim_after=time.time() + self.interruptable_timeout)
+
+		cursor = self.connection.cursor(name="4cat-%s" % uuid.uuid4().hex, cursor_factory=psycopg2.extras.RealDictCursor, withhold=True)
+		cursor.itersize = itersize
+		self.log.debug("Executing streaming query in connection %s" % self.appname)
+
+		try:
+			cursor.execute(query, *args)
+			for row in cursor:
+				yield row
+		except psycopg2.extensions.QueryCanceledError:
+			# interrupted with cancellation worker (or manually)
+			self.log.debug("Query in connection %s was interrupted..." % self.appname)
+			self.rollback()
+			raise DatabaseQueryInterruptedException("Interrupted while querying database")
+		finally:
+			try:
+				cursor.close()
+			except psycopg2.Error:
+				# the cursor no longer exists if the transaction it was
+				# declared in was rolled back (e.g. after cancelling the
+				# query); clear the failed CLOSE so the cleanup below works
+				self.rollback()
+
+			if self.interruptable_job:
+				self.interruptable_job.finish()
+				self.interruptable_job = None
+
+			self.commit()
 
 	def commit(self):
 		"""
@@ -410,13 +483,18 @@ class Database:
 		"""
 		self.connection.close()
 
-	def get_cursor(self):
+	def get_cursor(self, as_tuples=False):
 		"""
 		Get a new cursor
 
 		Re-using cursors seems to give issues when using per-thread
 		connections, so simply instantiate a new one each time
 
+		:param bool as_tuples:  Get a cursor that returns rows as tuples,
+		rather than as dictionaries
 		:return: Cursor
 		"""
+		if as_tuples:
+			return self.connection.cursor()
+
 		return self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
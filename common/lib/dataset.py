@@ -332,13 +332,16 @@ class DataSet(FourcatModule):
 
 		# Loop through items
 		for item in self.iterate_items(processor=processor, bypass_map_item=True):
-			# Save original to yield
-			original_item = item.copy()
-
 			# Map item for filter
 			if item_mapper:
+				# Save original to yield, since the mapper may modify the
+				# item in place
+				original_item = item.copy()
 				mapped_item = item_mapper(item)
 			else:
+				# the item was freshly read from the file and is not
+				# referenced anywhere else, so there is no need to copy it
+				original_item = item
 				mapped_item = original_item
 
 			# Yield the two items
@@ -6,11 +6,14 @@ import subprocess
 from urllib.parse import urlparse
 import requests
 import datetime
+import lxml.etree
+import lxml.html
 import smtplib
 import socket
 import copy
 import time
 import json
+import itertools
 import math
 import csv
 import re
@@ -41,10 +44,40 @@ def init_datasource(database, logger, queue, name):
     pass
 
 
+DEDUPLICATE_NEWLINES = re.compile(r"\n+")
+FULL_DOCUMENT_TAG = re.compile(r"<(?:html|head)(?:[\s/>]|$)", flags=re.IGNORECASE)
+
+
+class HTMLStripper(HTMLParser):
+    """
+    HTML parser that only keeps text content
+
+    Used by `strip_tags()` for full documents and strings that lxml cannot
+    parse.
+    """
+    def __init__(self):
+        super().__init__()
+        self.reset()
+        self.strict = False
+        self.convert_charrefs = True
+        self.fed = []
+
+    def handle_data(self, data):
+        self.fed.append(data)
+
+    def get_data(self):
+        return "".join(self.fed)
+
+
 def strip_tags(html, convert_newlines=True):
     """
     Strip HTML from a string
 
+    HTML is parsed with lxml, which is considerably faster than the built-in
+    HTMLParser. The latter is used for full HTML documents (i.e. with an
+    <html> or <head> tag) and as a fallback if lxml fails to parse the
+    string. Note that lxml replaces NUL bytes with spaces.
+
     :param html: HTML to strip
     :param convert_newlines: Convert <br> and </p> tags to \n before stripping
     :return: Stripped HTML
@@ -52,25 +85,28 @@ def strip_tags(html, convert_newlines=True):
     if not html:
         return ""
 
-    deduplicate_newlines = re.compile(r"\n+")
-
     if convert_newlines:
         html = html.replace("<br>", "\n").replace("</p>", "</p>\n")
-        html = deduplicate_newlines.sub("\n", html)
+        html = DEDUPLICATE_NEWLINES.sub("\n", html)
 
-    class HTMLStripper(HTMLParser):
-        def __init__(self):
-            super().__init__()
-            self.reset()
-            self.strict = False
-            self.convert_charrefs = True
-            self.fed = []
+    # without tags or character references there is nothing to parse
+    if "<" not in html and "&" not in html:
+        return html
 
-        def handle_data(self, data):
-            self.fed.append(data)
+    # lxml discards text before the first tag if it is only whitespace, so
+    # keep that separately (e.g. the newline for a leading <br>)
+    content = html.lstrip()
+    leading_whitespace = html[:len(html) - len(content)]
 
-        def get_data(self):
-            return "".join(self.fed)
+    # lxml's fragment parser cannot handle full documents (it would drop
+    # text from the <head>, or fail entirely), so leave those to the
+    # fallback
+    if not FULL_DOCUMENT_TAG.search(content):
+        try:
+            return leading_whitespace + lxml.html.fragment_fromstring(content, create_parent=True).text_content()
+        except (AssertionError, ValueError, lxml.etree.LxmlError):
+            # lxml raises AssertionError for some malformed documents
+            pass
 
     stripper = HTMLStripper()
     stripper.feed(html)
@@ -296,6 +332,26 @@ def get_yt_compatible_ids(yt_ids):
     return ids
 
 
+def batched(iterable, n):
+    """
+    Split an iterable into batches of a given size
+
+    The last batch may be shorter than `n` if the amount of items is not
+    divisible by it.
+
+    :param iterable:  Iterable to split
+    :param int n:  Batch size
+    :return Generator:  Yields batches, as tuples
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = tuple(itertools.islice(iterator, n))
+        if not batch:
+            return
+
+        yield batch
+
+
 def get_4cat_canvas(path, width, height, header=None, footer="made with 4CAT", fontsize_normal=None,
                     fontsize_small=None, fontsize_large=None):
     """
@@ -221,6 +221,11 @@ class Logger:
         if self.print_logs and level > logging.DEBUG:
             print("LOG: %s" % message)
 
+        # determining the location is relatively expensive, so don't bother
+        # if the message would be discarded anyway
+        if not self.logger.isEnabledFor(level):
+            return
+
         # logging can include the full stack trace in the log, but that's a
         # bit excessive - instead, only include the location the log was called
         if not frame:
@@ -67,6 +67,13 @@ CREATE INDEX IF NOT EXISTS posts_timestamp_8chan
     timestamp
   );
 
+-- used by queries that select posts from a board by date range, which are
+-- also ordered by timestamp
+CREATE INDEX IF NOT EXISTS posts_board_timestamp_8chan
+  ON posts_8chan (
+    board, timestamp
+  );
+
 CREATE INDEX IF NOT EXISTS posts_thread_8chan
   ON posts_8chan (
     thread_id
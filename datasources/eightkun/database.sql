@@ -72,6 +72,13 @@ CREATE INDEX IF NOT EXISTS posts_timestamp_8kun
     timestamp
   );
 
+-- used by queries that select posts from a board by date range, which are
+-- also ordered by timestamp
+CREATE INDEX IF NOT EXISTS posts_board_timestamp_8kun
+  ON posts_8kun (
+    board, timestamp
+  );
+
 CREATE INDEX IF NOT EXISTS posts_thread_8kun
   ON posts_8kun (
     thread_id
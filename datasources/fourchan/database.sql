@@ -75,6 +75,13 @@ CREATE INDEX IF NOT EXISTS posts_timestamp
     timestamp
   );
 
+-- used by queries that select posts from a board by date range, which are
+-- also ordered by timestamp
+CREATE INDEX IF NOT EXISTS posts_board_timestamp
+  ON posts_4chan (
+    board, timestamp
+  );
+
 CREATE INDEX IF NOT EXISTS posts_thread
   ON posts_4chan (
     thread_id
@@ -1,6 +1,7 @@
 """
 4chan Search via Sphinx
 """
+import itertools
 import warnings
 import time
 
@@ -9,10 +10,34 @@ from pymysql.err import Warning as SphinxWarning
 
 import common.config_manager as config
 from backend.lib.database_mysql import MySQLDatabase
-from common.lib.helpers import UserInput
+from common.lib.helpers import UserInput, batched
 from backend.abstract.search import SearchWithScope
 from common.lib.exceptions import QueryParametersException, ProcessorInterruptedException
 
+# countries that can be selected at once via the 'European countries' option
+EUROPE_COUNTRIES = (
+	"Armenia", "Albania", "Andorra", "Austria", "Belarus", "Belgium", "Bosnia and Herzegovina",
+	"Bulgaria", "Croatia", "Cyprus", "Czech Republic", "Denmark", "Estonia", "Finland", "France",
+	"Germany", "Greece", "Hungary", "Iceland", "Republic of Ireland", "Italy", "Kosovo", "Latvia",
+	"Liechtenstein", "Lithuania", "Luxembourg", "Republic of Macedonia", "North Macedonia",
+	"Macedonia", "Malta", "Moldova", "Monaco", "Montenegro", "Netherlands", "The Netherlands",
+	"Norway", "Poland", "Portugal", "Romania", "Russia", "San Marino", "Serbia", "Slovakia",
+	"Slovenia", "Spain", "Sweden", "Switzerland", "Turkey", "Ukraine", "United Kingdom",
+	"Vatican City"
+)
+
+# converts curly quotes to straight quotes, and escapes characters that have
+# a special meaning in SphinxQL but should be matched literally. Other special
+# characters (e.g. | or -) are left alone since they are part of the query
+# syntax users may use
+SPHINX_TRANSLATION = str.maketrans({
+	"“": "\"",
+	"”": "\"",
+	"/": "\\/",
+	"@": "\\@"
+})
+
+
 
 class Search4Chan(SearchWithScope):
 	"""
@@ -39,6 +64,10 @@ class Search4Chan(SearchWithScope):
 	# request_abort() later
 	running_query = ""
 
+	# post data for matching posts is fetched in batches of this many IDs, to
+	# keep the size of individual queries manageable
+	fetch_batch_size = 10000
+
 	options = {
 		"intro": {
 			"type": UserInput.OPTION_INFO,
@@ -75,7 +104,7 @@ class Search4Chan(SearchWithScope):
 			"board_specific": ["pol", "sp", "int"],
 			"tooltip": "The IP-derived flag attached to posts. Can be an actual country or \"meme flag\". Leave empty for all.",
 			"options": {
-				"Armenia|Albania|Andorra|Austria|Belarus|Belgium|Bosnia and Herzegovina|Bulgaria|Croatia|Cyprus|Czech Republic|Denmark|Estonia|Finland|France|Germany|Greece|Hungary|Iceland|Republic of Ireland|Italy|Kosovo|Latvia|Liechtenstein|Lithuania|Luxembourg|Republic of Macedonia|North Macedonia|Macedonia|Malta|Moldova|Monaco|Montenegro|Netherlands|The Netherlands|Norway|Poland|Portugal|Romania|Russia|San Marino|Serbia|Slovakia|Slovenia|Spain|Sweden|Switzerland|Turkey|Ukraine|United Kingdom|Vatican City": "European countries",
+				"|".join(EUROPE_COUNTRIES): "European countries",
 				"Afghanistan": "<span class='flag flag-af' title='Afghanistan'></span> Afghanistan",
 				"Aland Islands|Aland": "<span class='flag flag-ax' title='Aland / Aland Islands'></span> Aland Islands",
 				"Albania": "<span class='flag flag-al' title='Albania'></span> Albania",
@@ -436,20 +465,24 @@ class Search4Chan(SearchWithScope):
 				pass
 
 		if query.get("country_name", None):
+			country_names = self.get_country_names(query)
+			if not country_names:
+				# no need to query, none of these will match anything
+				self.dataset.update_status("None of the selected countries are valid for this data source.", is_final=True)
+				return None
+
+			where.append("country_name = ANY(%s)")
+			replacements.append(country_names)
+
+		# for thread-based search scopes, only the thread IDs of matching
+		# posts are used - all posts in those threads are fetched later - so
+		# there is no need to retrieve anything else
+		if query.get("search_scope", None) in ("full-threads", "dense-threads"):
+			columns = "thread_id"
+		else:
+			columns = self.sql_columns
 
-			# Separate merged names
-			country_names = []
-			for country_name in query["country_name"]:
-				country_name = country_name.split("|")
-				for c in country_name:
-					country_names.append(c)
-
-			where.append("country_name IN %s")
-
-			replacements.append(tuple(country_names))
-
-
-		sql_query = ("SELECT " + ",".join(self.return_cols) +
+		sql_query = ("SELECT " + columns +
 					 " FROM posts_" + self.prefix +
 					 " LEFT JOIN posts_" + self.prefix + "_deleted" +
 					 " ON posts_" + self.prefix + ".id_seq = posts_" + self.prefix + "_deleted.id_seq" \
@@ -474,7 +507,7 @@ class Search4Chan(SearchWithScope):
 						try:
 							# Make sure the text can be parsed to an integer.
 							query_id = int(query_id.strip())
-							valid_query_ids.append(str(query_id))
+							valid_query_ids.append(query_id)
 						except ValueError:
 							# If not, just skip it.
 							continue
@@ -486,8 +519,8 @@ class Search4Chan(SearchWithScope):
 						self.dataset.update_status("Too many IDs inserted. Max 5.000.000.")
 						return None
 
-					valid_query_ids = "(" + ",".join(valid_query_ids) + ")"
-					sql_query = "SELECT * FROM (" + sql_query + " AND id IN " + valid_query_ids + ") AS ids ORDER BY timestamp ASC"
+					sql_query += " AND id = ANY(%s) ORDER BY timestamp ASC"
+					replacements.append(valid_query_ids)
 
 				else:
 					self.dataset.update_status("No 4chan post IDs inserted.")
@@ -499,7 +532,7 @@ class Search4Chan(SearchWithScope):
 		else:
 			sql_query += " ORDER BY timestamp ASC"
 
-		return self.db.fetchall_interruptable(self.queue, sql_query, replacements)
+		return self.db.fetch_iter(sql_query, replacements, queue=self.queue)
 
 	def get_items_complex(self, query):
 		"""
@@ -514,7 +547,6 @@ class Search4Chan(SearchWithScope):
 		:param dict query:  Query parameters, as part of the DataSet object
 		:return list:  Posts, sorted by thread and post ID, in ascending order
 		"""
-
 		# first, build the sphinx query
 		where = []
 		replacements = []
@@ -529,6 +561,12 @@ class Search4Chan(SearchWithScope):
 		# Option wether to use sphinx for text searches
 		use_sphinx = config.get("fourchan.use_sphinx", True)
 
+		# without anything to match on (e.g. only whitespace), Sphinx cannot
+		# use its full-text index and would need to scan every post, only for
+		# the results to be fetched from the database anyway - so skip it
+		if use_sphinx and not (query.get("body_match") or "").strip() and not (query.get("subject_match") or "").strip():
+			return self.get_items_simple(query)
+
 		if query.get("min_date", None):
 			try:
 				if int(query.get("min_date")) > 0:
@@ -563,15 +601,20 @@ class Search4Chan(SearchWithScope):
 		else:
 			if query.get("body_match", None):
 				where.append("lower(body) LIKE %s")
-				replacements.append("%" + query["body_match"] + "%")
+				replacements.append("%" + query["body_match"].lower() + "%")
 			if query.get("subject_match", None):
 				where.append("lower(subject) LIKE %s")
-				replacements.append("%" + query["subject_match"] + "%")
+				replacements.append("%" + query["subject_match"].lower() + "%")
 
 		# handle country names through sphinx
 		if query.get("country_name", None) and not query.get("check_dense_country", None):
+			country_names = self.get_country_names(query)
+			if not country_names:
+				self.dataset.update_status("None of the selected countries are valid for this data source.", is_final=True)
+				return None
+
 			where.append("country_name IN %s")
-			replacements.append(tuple(query.get("country_name")))
+			replacements.append(tuple(country_names))
 
 		# both possible FTS parameters go in one MATCH() operation
 		if match and use_sphinx:
@@ -581,25 +624,22 @@ class Search4Chan(SearchWithScope):
 		# query Sphinx
 		self.dataset.update_status("Searching for matches")
 
-		where = " AND ".join(where)
-
 		if use_sphinx:
-			posts = self.fetch_sphinx(where, replacements)
+			posts = self.fetch_sphinx(" AND ".join(where), replacements)
 		# Query the postgres table immediately if we're not using sphinx.
 		else:
-			columns = ", ".join(self.return_cols)
 			if self.interrupted:
 				raise ProcessorInterruptedException("Interrupted while fetching post data")
 
 			# Join on the posts_{datasource}_deleted table so we can also retrieve whether the post was deleted
 			join = " LEFT JOIN posts_%s_deleted ON posts_%s.id_seq = posts_%s_deleted.id_seq " % tuple([self.prefix] * 3)
-			
+
 			# Duplicate code, but will soon be changed anyway...
 			if not query.get("get_deleted"):
-				where += " AND posts_%s_deleted.id_seq IS NULL" % self.prefix
+				where.append("posts_%s_deleted.id_seq IS NULL" % self.prefix)
 
-			query = "SELECT " + columns + "FROM posts_" + self.prefix + join + " WHERE " + where + " ORDER BY id ASC"
-			posts = self.db.fetchall_interruptable(self.queue, query, replacements)
+			sql_query = "SELECT " + self.sql_columns + " FROM posts_" + self.prefix + join + " WHERE " + " AND ".join(where) + " ORDER BY id ASC"
+			posts = self.db.fetchall_interruptable(self.queue, sql_query, replacements)
 
 		if posts is None:
 			return posts
@@ -614,22 +654,46 @@ class Search4Chan(SearchWithScope):
 
 		# else we query the posts database
 		self.dataset.update_status("Found %i initial matches. Collecting post data" % len(posts))
-		datafetch_start = time.time()
 		self.log.info("Collecting post data from database")
-		columns = ", ".join(self.return_cols)
 
 		# Do a JOIN so we can check for deleted posts.
 		postgres_join = " LEFT JOIN posts_%s_deleted ON posts_%s.id_seq = posts_%s_deleted.id_seq " % tuple([self.prefix] * 3)
 		if not query.get("get_deleted"):
 			postgres_where.append("posts_%s_deleted.id_seq IS NULL" % self.prefix)
 
-		posts_full = self.fetch_posts(tuple([post["post_id"] for post in posts]), join=postgres_join, where=postgres_where, replacements=postgres_replacements)
-		
-		self.dataset.update_status("Post data collected")
-		self.log.info("Full posts query finished in %i seconds." % (time.time() - datafetch_start))
+		# fetch in batches (in ID order, so the combined result is ordered
+		# as well)
+		post_ids = sorted([post["post_id"] for post in posts])
+		posts_full = itertools.chain.from_iterable(
+			self.fetch_posts(batch, join=postgres_join, where=postgres_where, replacements=postgres_replacements)
+			for batch in batched(post_ids, self.fetch_batch_size))
 
 		return posts_full
 
+	def get_country_names(self, query):
+		"""
+		Get country names to filter on for a query
+
+		Options for the country filter may combine multiple names, separated
+		by `|` (e.g. 'European countries'); these are split into separate
+		names. Names that are not one of the possible options are discarded,
+		since posts with those will not exist anyway and there is no point in
+		asking the database to look for them.
+
+		:param dict query:  Query parameters
+		:return list:  Country names to filter on; empty if there are no
+		valid names
+		"""
+		valid_names = set()
+		for option in self.options.get("country_name", {}).get("options", {}):
+			valid_names.update(option.split("|"))
+
+		country_names = []
+		for country_name in query.get("country_name", []):
+			country_names.extend([c for c in country_name.split("|") if c in valid_names])
+
+		return country_names
+
 	def convert_for_sphinx(self, string):
 		"""
 		SphinxQL has a couple of special characters that should be escaped if
@@ -644,14 +708,7 @@ class Search4Chan(SearchWithScope):
 		:param str string:  String to escape
 		:return str: Escaped string
 		"""
-	
-		# Convert curly quotes
-		string = string.replace("“", "\"").replace("”", "\"")
-		# Escape forward slashes
-		string = string.replace("/", "\\/")
-		# Escape @
-		string = string.replace("@", "\\@")
-		return string
+		return string.translate(SPHINX_TRANSLATION)
 
 	def fetch_posts(self, post_ids, join="", where=None, replacements=None):
 		"""
@@ -661,35 +718,30 @@ class Search4Chan(SearchWithScope):
 		:param join, str: A potential JOIN statement
 		:param where, list: A potential WHERE statemement
 		:param replacements, list: The values to add in the JOIN and WHERE statements
-		:return list: List of posts, with a dictionary representing the database record for each post
+		:return Generator: Yields posts, as dictionaries representing the database record for each post
 		"""
-		if not where:
-			where = []
+		# copy, since this may be called repeatedly with the same parameters
+		where = list(where) if where else []
+		replacements = list(replacements) if replacements else []
 
-		if not replacements:
-			replacements = []
-
-		columns = ", ".join(self.return_cols) 
-		where.append("id IN %s")
-		replacements.append(post_ids)
+		where.append("id = ANY(%s)")
+		replacements.append(list(post_ids))
 
 		if self.interrupted:
 			raise ProcessorInterruptedException("Interrupted while fetching post data")
 
-		query = "SELECT " + columns + " FROM posts_" + self.prefix + " " + join + " WHERE " + " AND ".join(
+		query = "SELECT " + self.sql_columns + " FROM posts_" + self.prefix + " " + join + " WHERE " + " AND ".join(
 			where) + " ORDER BY id ASC"
 
-		return self.db.fetchall_interruptable(self.queue, query, replacements)
+		return self.db.fetch_iter(query, replacements, queue=self.queue)
 
 	def fetch_threads(self, thread_ids):
 		"""
 		Fetch post from database for given threads
 
 		:param list thread_ids: List of thread IDs to return post data for
-		:return list: List of posts, with a dictionary representing the database record for each post
+		:return Generator: Yields posts, as dictionaries representing the database record for each post
 		"""
-		columns = ", ".join(self.return_cols)
-
 		if self.interrupted:
 			raise ProcessorInterruptedException("Interrupted while fetching thread data")
 
@@ -698,12 +750,12 @@ class Search4Chan(SearchWithScope):
 		if self.parameters.get("get_deleted") is False:
 			exclude_deleted = "AND posts_" + self.prefix + "_deleted.id_seq IS NULL"
 
-		return self.db.fetchall_interruptable(self.queue,
-			"SELECT " + columns + " FROM posts_" + self.prefix + " \
+		return self.db.fetch_iter(
+			"SELECT " + self.sql_columns + " FROM posts_" + self.prefix + " \
 			LEFT JOIN posts_" + self.prefix + "_deleted ON posts_" + self.prefix + ".id_seq \
 			 = posts_" + self.prefix + "_deleted.id_seq \
-			WHERE thread_id IN %s " + exclude_deleted + " \
-			ORDER BY thread_id ASC, id ASC", (thread_ids,))
+			WHERE thread_id = ANY(%s) " + exclude_deleted + " \
+			ORDER BY thread_id ASC, id ASC", (list(thread_ids),), queue=self.queue)
 
 	def fetch_sphinx(self, where, replacements, join=""):
 		"""
@@ -731,7 +783,6 @@ class Search4Chan(SearchWithScope):
 			self.log.info("Running Sphinx query %s " % parsed_query)
 			self.running_query = parsed_query
 			results = sphinx.fetchall(parsed_query, [])
-			sphinx.close()
 		except SphinxWarning as e:
 			# this is a pymysql warning converted to an exception
 			if "query was killed" in str(e):
@@ -760,6 +811,10 @@ class Search4Chan(SearchWithScope):
 					"Error during query. Please try a narrow query and double-check your syntax.", is_final=True)
 				self.log.error("Sphinx crash during query %s: %s" % (self.dataset.key, e))
 			return None
+		finally:
+			# close the connection regardless of outcome, so failed queries
+			# do not leave connections to Sphinx open
+			sphinx.close()
 
 		self.log.info("Sphinx query finished in %i seconds, %i results." % (time.time() - sphinx_start, len(results)))
 		return results
@@ -787,13 +842,54 @@ class Search4Chan(SearchWithScope):
 		results
 		:return dict:  Threads sizes, with thread IDs as keys
 		"""
-		# find total thread lengths for all threads in initial data set
-		thread_sizes = {row["thread_id"]: row["num_posts"] for row in self.db.fetchall_interruptable(
-			self.queue, "SELECT COUNT(*) as num_posts, thread_id FROM posts_" + self.prefix + " WHERE thread_id IN %s GROUP BY thread_id",
-			(thread_ids,)) if int(row["num_posts"]) > min_length}
+		# find total thread lengths for all threads in initial data set; only
+		# threads that are long enough are returned by the database
+		thread_sizes = {thread_id: num_posts for thread_id, num_posts in self.db.fetchall_interruptable(
+			self.queue, self.get_thread_sizes_query(), (list(thread_ids), min_length), as_tuples=True)}
 
 		return thread_sizes
 
+	def get_thread_sizes_query(self):
+		"""
+		Get SQL query for the lengths of threads that are long enough
+
+		Used both by `get_thread_sizes()` and as part of the query in
+		`get_dense_thread_ids()`. Takes two parameters: a list of thread IDs
+		and the minimum thread length.
+
+		:return str:  SQL query returning `thread_id` and `num_posts` columns
+		"""
+		return "SELECT thread_id, COUNT(*) AS num_posts FROM posts_" + self.prefix + " \
+			WHERE thread_id = ANY(%s) GROUP BY thread_id HAVING COUNT(*) > %s"
+
+	def get_dense_thread_ids(self, items_per_thread, min_length, density):
+		"""
+		Get IDs of threads in which enough items match
+
+		Rather than retrieving the length of every thread and comparing it
+		with the amount of matching posts here, the matching post counts are
+		sent along with the query so only qualifying thread IDs are returned.
+
+		:param dict items_per_thread:  Amount of matching items, with thread
+		IDs as keys
+		:param int min_length:  Min length for a thread to be included in the
+		results
+		:param float density:  Proportion of items in a thread that need to
+		match, between 0 and 1
+		:return set:  IDs of qualifying threads
+		"""
+		if not items_per_thread:
+			return set()
+
+		thread_ids = list(items_per_thread.keys())
+		num_matching = [items_per_thread[thread_id] for thread_id in thread_ids]
+
+		return {row[0] for row in self.db.fetchall_interruptable(self.queue,
+			"SELECT matching.thread_id FROM unnest(%s, %s) AS matching(thread_id, num_matching) \
+			INNER JOIN (" + self.get_thread_sizes_query() + ") AS sizes ON sizes.thread_id = matching.thread_id \
+			WHERE matching.num_matching >= CEIL(%s * sizes.num_posts)",
+			(thread_ids, num_matching, thread_ids, min_length, density), as_tuples=True)}
+
 	def validate_query(query, request, user):
 		"""
 		Validate input for a dataset query on the 4chan data source.
@@ -809,7 +905,8 @@ class Search4Chan(SearchWithScope):
 		"""
 
 		# this is the bare minimum, else we can't narrow down the full data set
-		if not user.is_admin and not user.get_value("4chan.can_query_without_keyword", False) and not query.get("body_match", None) and not query.get("subject_match", None) and query.get("search_scope", "") != "random-sample" and query.get("search_scope","") != "match-ids":
+		# (whitespace-only queries don't narrow anything down either)
+		if not user.is_admin and not user.get_value("4chan.can_query_without_keyword", False) and not (query.get("body_match") or "").strip() and not (query.get("subject_match") or "").strip() and query.get("search_scope", "") != "random-sample" and query.get("search_scope","") != "match-ids":
 			raise QueryParametersException("Please provide a message or subject search query")
 
 		query["min_date"], query["max_date"] = query["daterange"]
@@ -844,3 +941,5 @@ class Search4Chan(SearchWithScope):
 			if thread["Info"] == self.running_query:
 				self.log.info("Killing Sphinx query %s" % thread["Tid"])
 				sphinx.query("KILL %s" % thread["Tid"])
+
+		sphinx.close()
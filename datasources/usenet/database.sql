@@ -10,6 +10,16 @@ CREATE TABLE IF NOT EXISTS posts_usenet (
   groups      TEXT
 );
 
+CREATE INDEX IF NOT EXISTS posts_timestamp_usenet
+  ON posts_usenet (
+    timestamp
+  );
+
+CREATE INDEX IF NOT EXISTS posts_thread_usenet
+  ON posts_usenet (
+    thread_id
+  );
+
 CREATE TABLE IF NOT EXISTS threads_usenet (
   id          TEXT UNIQUE,
   id_seq      SERIAL,  -- sequential ID for easier indexing
@@ -1,9 +1,9 @@
 """
 Usenet Search via Sphinx
 """
-import time
+import itertools
 
-from common.lib.helpers import UserInput
+from common.lib.helpers import UserInput, batched
 from common.lib.exceptions import QueryParametersException, ProcessorInterruptedException
 from datasources.fourchan.search_4chan import Search4Chan
 
@@ -111,16 +111,22 @@ class SearchUsenet(Search4Chan):
 			except ValueError:
 				pass
 
-		sql_query = ("SELECT p.* " \
-					 "FROM posts_" + self.prefix + " AS p " \
-					 "WHERE 1 ")
+		# for thread-based search scopes, only the thread IDs of matching
+		# posts are used, so there is no need to retrieve anything else
+		if query.get("search_scope", None) in ("full-threads", "dense-threads"):
+			columns = "p.thread_id"
+		else:
+			columns = "p.*"
+
+		sql_query = ("SELECT " + columns + " " \
+					 "FROM posts_" + self.prefix + " AS p ")
 
 		if where:
-			sql_query += " AND " + " AND ".join(where)
+			sql_query += " WHERE " + " AND ".join(where)
 
 		sql_query += " ORDER BY p.timestamp ASC"
 
-		return self.db.fetchall_interruptable(self.queue, sql_query, replacements)
+		return self.db.fetch_iter(sql_query, replacements, queue=self.queue)
 
 	def get_items_complex(self, query):
 		"""
@@ -183,19 +189,17 @@ class SearchUsenet(Search4Chan):
 
 		# query posts database
 		self.dataset.update_status("Found %i matches. Collecting post data" % len(posts))
-		datafetch_start = time.time()
 		self.log.info("Collecting post data from database")
-		columns = ", ".join(self.return_cols)
 
 		postgres_where = []
 		postgres_replacements = []
 
 		groups = [group.strip().replace("*", "%") for group in query.get("group_match", "").split(",")]
 		groups = [group for group in groups if group]
-		posts_full = self.fetch_posts(tuple([post["post_id"] for post in posts]), postgres_where, postgres_replacements, groups)
-
-		self.dataset.update_status("Post data collected")
-		self.log.info("Full posts query finished in %i seconds." % (time.time() - datafetch_start))
+		post_ids = sorted([post["post_id"] for post in posts])
+		posts_full = itertools.chain.from_iterable(
+			self.fetch_posts(batch, postgres_where, postgres_replacements, groups)
+			for batch in batched(post_ids, self.fetch_batch_size))
 
 		return posts_full
 
@@ -204,17 +208,14 @@ class SearchUsenet(Search4Chan):
 		Fetch post data from database
 
 		:param list post_ids:  List of post IDs to return data for
-		:return list: List of posts, with a dictionary representing the database record for each post
+		:return Generator: Yields posts, as dictionaries representing the database record for each post
 		"""
-		if not where:
-			where = []
-
-		if not replacements:
-			replacements = []
+		# copy, since this may be called repeatedly with the same parameters
+		where = list(where) if where else []
+		replacements = list(replacements) if replacements else []
 
-		columns = ", ".join(self.return_cols)
-		where.append("id IN %s")
-		replacements.append(post_ids)
+		where.append("id = ANY(%s)")
+		replacements.append(list(post_ids))
 
 		if self.interrupted:
 			raise ProcessorInterruptedException("Interrupted while fetching post data")
@@ -223,9 +224,9 @@ class SearchUsenet(Search4Chan):
 			where.append("id IN ( SELECT post_id FROM groups_" + self.prefix + " WHERE \"group\" LIKE ANY(%s) )")
 			replacements.append(groups)
 
-		query = "SELECT " + columns + " FROM posts_" + self.prefix + " WHERE " + " AND ".join(
+		query = "SELECT " + self.sql_columns + " FROM posts_" + self.prefix + " WHERE " + " AND ".join(
 			where) + " ORDER BY id ASC"
-		return self.db.fetchall_interruptable(self.queue, query, replacements)
+		return self.db.fetch_iter(query, replacements, queue=self.queue)
 
 	def validate_query(query, request, user):
 		"""
@@ -242,7 +243,7 @@ class SearchUsenet(Search4Chan):
 		"""
 
 		# this is the bare minimum, else we can't narrow down the full data set
-		if not user.is_admin and not user.get_value("usenet.can_query_without_keyword", False) and not query.get("body_match", None) and not query.get("subject_match", None) and query.get("search_scope",	"") != "random-sample":
+		if not user.is_admin and not user.get_value("usenet.can_query_without_keyword", False) and not (query.get("body_match") or "").strip() and not (query.get("subject_match") or "").strip() and query.get("search_scope",	"") != "random-sample":
 			raise QueryParametersException("Please provide a body query, subject query or random sample size.")
 
 		# the dates need to make sense as a range to search within
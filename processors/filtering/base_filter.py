@@ -5,6 +5,8 @@ import abc
 import csv
 import json
 
+from operator import itemgetter
+
 from backend.abstract.processor import BasicProcessor
 
 __author__ = "Dale Wahl"
@@ -24,6 +26,9 @@ class BaseFilter(BasicProcessor):
     title = "Base Filter"  # title displayed in UI
     description = "This should not be available."
 
+    # minimum amount of seconds between status updates while filtering
+    status_interval = 1
+
     @classmethod
     def is_compatible_with(cls, module=None):
         """
@@ -51,15 +56,48 @@ class BaseFilter(BasicProcessor):
                 writer = None
                 for post in matching_posts:
                     if not writer:
-                        writer = csv.DictWriter(outfile, fieldnames=post.keys())
-                        writer.writeheader()
-                    writer.writerow(post)
+                        # items usually have the same columns, so rather than
+                        # using a DictWriter, which maps each item to the
+                        # columns separately, build a getter for the values
+                        # once
+                        fieldnames = list(post.keys())
+                        if len(fieldnames) > 1:
+                            get_row = itemgetter(*fieldnames)
+                        else:
+                            get_row = lambda item: (item[fieldnames[0]],)
+
+                        writer = csv.writer(outfile)
+                        writer.writerow(fieldnames)
+
+                    # an item with as many columns as the first item, all of
+                    # which exist, has exactly the same columns
+                    try:
+                        row = get_row(post) if len(post) == len(fieldnames) else None
+                    except KeyError:
+                        row = None
+
+                    if row is None:
+                        # like DictWriter, refuse to silently drop columns
+                        # that are not in the first item
+                        extra_fields = post.keys() - set(fieldnames)
+                        if extra_fields:
+                            raise ValueError("dict contains fields not in fieldnames: " + ", ".join([repr(field) for field in extra_fields]))
+
+                        # columns missing for this item are left empty
+                        row = [post.get(field, "") for field in fieldnames]
+
+                    writer.writerow(row)
                     num_posts += 1
         elif parent_extension == "ndjson":
+            # items are read from JSON, so they cannot contain circular
+            # references and there is no need to check for them
+            encoder = json.JSONEncoder(check_circular=False)
             with self.dataset.get_results_path().open("w", encoding="utf-8", newline="") as outfile:
                 for post in matching_posts:
-
-                    outfile.write(json.dumps(post) + "\n")
+                    # write separately rather than concatenating the newline,
+                    # which would copy the whole (possibly large) string
+                    outfile.write(encoder.encode(post))
+                    outfile.write("\n")
                     num_posts += 1
         else:
             raise NotImplementedError("Parent datasource of type %s cannot be filtered" % parent_extension)
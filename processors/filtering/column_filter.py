@@ -1,9 +1,12 @@
 """
 Filter posts by a given column
 """
-import re
+import ahocorasick
+import time
 import datetime
 
+from operator import itemgetter
+
 from processors.filtering.base_filter import BaseFilter
 from common.lib.helpers import UserInput, convert_to_int
 
@@ -121,91 +124,158 @@ class ColumnFilter(BaseFilter):
         elif match_style in("top", "bottom"):
             for item in self.filter_top(column, match_values[0], (match_style=="bottom")):
                 yield item
+            return
 
         # pre-process dates to compare to
         elif match_style in ("after", "before"):
-            # this is a little inefficient, but we need to make sure the values
-            # can actually be interpreted as dates, either via a timestamp or a
-            # unix epoch offset
-            ok_format = all(
-                [re.match(r"[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}", value) for value in match_values])
-            if not ok_format:
-                try:
-                    match_values = [int(value) for value in match_values]
-                except (ValueError, TypeError):
-                    self.dataset.update_status("Cannot do '%s' comparison with value(s) that are not dates",
-                                               is_final=True)
-                    self.dataset.finish(0)
-                    return
-            else:
-                match_values = [datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp() for value in
-                                match_values]
+            # we need to make sure the values can actually be interpreted as
+            # dates, either via a timestamp or a unix epoch offset
+            try:
+                match_values = [self.parse_date(value) for value in match_values]
+            except (ValueError, TypeError):
+                self.dataset.update_status("Cannot do '%s' comparison with value(s) that are not dates",
+                                           is_final=True)
+                self.dataset.finish(0)
+                return
 
         # self.dataset.log('Criteria: column - %s, style - %s, multiple - %s, function - %s, values - %s' % (str(column), str(match_style), str(match_multiple), str(match_function), ' & '.join(match_values)))
 
+        matches = self.get_match_function(match_style, match_values, match_function)
+        get_value = itemgetter(column)
+        compare_dates = match_style in ("before", "after")
+
         matching_items = 0
         processed_items = 0
-        date_compare = None
+        last_update = time.monotonic()
         for original_item, mapped_item in self.source_dataset.iterate_mapped_items(self):
             processed_items += 1
-            if processed_items % 500 == 0:
+            if time.monotonic() - last_update >= self.status_interval:
                 self.dataset.update_status("Processed %i items (%i matching)" % (processed_items, matching_items))
                 self.dataset.update_progress(processed_items / self.source_dataset.num_rows)
+                last_update = time.monotonic()
+
+            try:
+                value = get_value(mapped_item)
+            except KeyError:
+                value = None
 
             # comparing dates is allowed on both unix timestamps and
             # 'human' timestamps. For that reason, if we *are* indeed
             # comparing dates, do some pre-processing to make sure we can
             # actually compare the value properly.
-            if match_style in ("before", "after"):
-                if re.match(r"[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}", mapped_item.get(column)):
-                    date_compare = datetime.datetime.strptime(mapped_item.get(column), "%Y-%m-%d %H:%M:%S").timestamp()
-                else:
-                    try:
-                        date_compare = int(mapped_item.get(column))
-                    except ValueError:
-                        self.dataset.update_status(
-                            "Invalid date value '%s', cannot determine if before or after" % mapped_item.get(column),
-                            is_final=True)
-                        self.dataset.finish(0)
-                        return
-
-            # depending on match type, mark as matching or not one way or
-            # another. This could be greatly optimised for some cases, e.g.
-            # when there is only a single value to compare to, and
-            # short-circuiting for 'any' matches - not clear if worth it.
-            matches = False
-            if match_style == "exact" and match_function([mapped_item.get(column) == value for value in match_values]):
-                matches = True
-            elif match_style == "exact-not" and match_function([mapped_item.get(column) != value for value in match_values]):
-                matches = True
-            elif match_style == "contains" and match_function([value in mapped_item.get(column) for value in match_values]):
-                matches = True
-            elif match_style == "contains-not" and match_function(
-                    [value not in mapped_item.get(column) for value in match_values]):
-                matches = True
-            elif match_style == "after" and match_function([value <= date_compare for value in match_values]):
-                matches = True
-            elif match_style == "before" and match_function([value >= date_compare for value in match_values]):
-                matches = True
-            else:
-                # wrap this in a try-catch because we cannot be sure that
-                # the column we're comparing to contains valid numerical
-                # values
+            if compare_dates:
                 try:
-                    if match_style == "greater-than" and match_function(
-                            [float(value) < float(mapped_item.get(column)) for value in match_values]):
-                        matches = True
-                    elif match_style == "less-than" and match_function(
-                            [float(value) > float(mapped_item.get(column)) for value in match_values]):
-                        matches = True
+                    value = self.parse_date(value)
                 except (TypeError, ValueError):
-                    # do not match
-                    pass
+                    self.dataset.update_status(
+                        "Invalid date value '%s', cannot determine if before or after" % value,
+                        is_final=True)
+                    self.dataset.finish(0)
+                    return
+
+            # wrap this in a try-catch because we cannot be sure that the
+            # column we're comparing to contains valid (e.g. numerical)
+            # values
+            try:
+                is_match = matches(value)
+            except (TypeError, ValueError):
+                # do not match
+                is_match = False
 
-            if matches:
+            if is_match:
                 yield original_item
                 matching_items += 1
 
+    @staticmethod
+    def parse_date(value):
+        """
+        Parse a date value to a unix timestamp
+
+        Values can be unix timestamps or 'YYYY-MM-DD HH:MM:SS' dates. The
+        latter are parsed with `datetime.fromisoformat()`, which is a lot
+        faster than `strptime()`.
+
+        :param value:  Value to parse
+        :return:  Unix timestamp
+        """
+        try:
+            return int(value)
+        except ValueError:
+            return datetime.datetime.fromisoformat(value).timestamp()
+
+    def get_match_function(self, match_style, match_values, match_function):
+        """
+        Get a function that determines whether a value matches
+
+        The comparison to make depends on the match style, but that is the
+        same for every item, so instead of deciding what to compare for each
+        item, this is decided once. With a single value to compare to, `any`
+        and `all` are equivalent, and the value is compared to directly. When
+        looking for multiple substrings, an Aho-Corasick automaton is used to
+        find all of them in a single pass over the value. Numerical and date
+        comparisons with multiple values are reduced to a comparison with a
+        single value.
+
+        :param str match_style:  Match style, e.g. `contains`
+        :param list match_values:  Values to compare to
+        :param match_function:  `any` or `all`
+        :return callable:  Function that takes an item's value and returns
+        whether it matches
+        """
+        if match_style in ("greater-than", "less-than", "after", "before") and len(match_values) > 1:
+            # comparing to several values is the same as comparing to the
+            # lowest or highest of them, depending on the direction of the
+            # comparison and whether any or all need to match
+            lower_bound = match_style in ("greater-than", "after")
+            if (match_function is any) == lower_bound:
+                match_values = [min(match_values)]
+            else:
+                match_values = [max(match_values)]
+
+        if match_style in ("contains", "contains-not") and len(match_values) > 1 and all(match_values):
+            # rather than scanning the value once for each match value, scan
+            # it once for all of them
+            unique_values = set(match_values)
+            automaton = ahocorasick.Automaton()
+            for match_value in unique_values:
+                automaton.add_word(match_value, match_value)
+            automaton.make_automaton()
+
+            contains_any = lambda value: next(automaton.iter(value), None) is not None
+            contains_all = lambda value: len({found for end, found in automaton.iter(value)}) == len(unique_values)
+
+            # 'any value is not contained' means 'not all are contained'
+            comparisons = {
+                "contains": contains_any if match_function is any else contains_all,
+                "contains-not": (lambda value: not contains_all(value)) if match_function is any else (lambda value: not contains_any(value))
+            }
+        elif len(match_values) == 1:
+            match_value = match_values[0]
+            comparisons = {
+                "exact": lambda value: value == match_value,
+                "exact-not": lambda value: value != match_value,
+                "contains": lambda value: match_value in value,
+                "contains-not": lambda value: match_value not in value,
+                "after": lambda value: match_value <= value,
+                "before": lambda value: match_value >= value,
+                "greater-than": lambda value: match_value < float(value),
+                "less-than": lambda value: match_value > float(value)
+            }
+        else:
+            comparisons = {
+                "exact": lambda value: match_function(value == match_value for match_value in match_values),
+                "exact-not": lambda value: match_function(value != match_value for match_value in match_values),
+                "contains": lambda value: match_function(match_value in value for match_value in match_values),
+                "contains-not": lambda value: match_function(match_value not in value for match_value in match_values),
+                "after": lambda value: match_function(match_value <= value for match_value in match_values),
+                "before": lambda value: match_function(match_value >= value for match_value in match_values),
+                "greater-than": lambda value: match_function(match_value < float(value) for match_value in match_values),
+                "less-than": lambda value: match_function(match_value > float(value) for match_value in match_values)
+            }
+
+        # unknown match style; nothing matches
+        return comparisons.get(match_style, lambda value: False)
+
     def filter_top(self, column, top_n, bottom=False):
         """
         Filter top n items
@@ -155,10 +155,12 @@ class LexicalFilter(BaseFilter):
 
                 lexicon_regex = lexicon_regexes[lexicon_id]
 
-                # check if we match
-                if not lexicon_regex.findall(mapped_item["body"]) and not exclude:
+                # check if we match - we only need to know if there is a
+                # match at all, so stop looking after the first one
+                has_match = lexicon_regex.search(mapped_item["body"]) is not None
+                if not has_match and not exclude:
                     continue
-                elif lexicon_regex.findall(mapped_item["body"]) and exclude:
+                elif has_match and exclude:
                     continue
 
                 matching_lexicons.add(lexicon_id)
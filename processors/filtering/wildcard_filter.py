@@ -72,7 +72,7 @@ class WildcardFilter(BaseFilter):
                 self.dataset.update_status("Processed %i posts (%i matching)" % (processed, matching_items))
                 self.dataset.update_progress(processed / self.source_dataset.num_rows)
 
-            if not matcher.findall(mapped_item.get("body")):
+            if not matcher.search(mapped_item.get("body")):
                 continue
 
             matching_items += 1
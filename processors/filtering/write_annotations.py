@@ -1,6 +1,8 @@
 """
 Write annotations to a dataset
 """
+import time
+
 from processors.filtering.base_filter import BaseFilter
 from common.lib.helpers import UserInput
 
@@ -60,43 +62,44 @@ class WriteAnnotations(BaseFilter):
 
 		annotation_labels = [v["label"] for v in annotation_fields.values()]
 
+		# every item gets a value for every field, empty unless annotated
+		empty_annotations = dict.fromkeys(annotation_labels, "")
+
 		to_lowercase = self.parameters.get("to-lowercase", False)
-		annotated_posts = set(annotations.keys())
 		post_count = 0
+		last_update = time.monotonic()
 		# iterate through posts and check if they appear in the annotations
 		for original_item, mapped_item in self.source_dataset.iterate_mapped_items(self):
 			post_count += 1
 
-			# Write the annotations to this row if they're present
-			if mapped_item["id"] in annotated_posts:
-				post_annotations = annotations[mapped_item["id"]]
-
-				# We're adding (empty) values for every field
-				for field in annotation_labels:
+			# get the ID first; without map_item(), mapped_item is the same
+			# object as original_item, and an annotation field could have
+			# the same name as the ID column
+			item_id = mapped_item["id"]
 
-					if field in post_annotations:
+			# We're adding (empty) values for every field
+			original_item.update(empty_annotations)
 
-						val = post_annotations[field]
-
-						# We join lists (checkboxes)
-						if isinstance(val, list):
-							val = ", ".join(val)
-						# Convert to lowercase if indicated
-						if to_lowercase:
-							val = val.lower()
-
-						# TODO: writting to ndjson is not visible in map_item/frontend
-						original_item[field] = val
-					else:
-						original_item[field] = ""
-
-			# Write empty values if this post has not been annotated
-			else:
-				for field in annotation_labels:
-					original_item[field] = ""
+			# Write the annotations to this row if they're present
+			post_annotations = annotations.get(item_id)
+			if post_annotations:
+				for field, val in post_annotations.items():
+					if field not in empty_annotations:
+						continue
+
+					# We join lists (checkboxes)
+					if isinstance(val, list):
+						val = ", ".join(val)
+					# Convert to lowercase if indicated
+					if to_lowercase:
+						val = val.lower()
+
+					# TODO: writting to ndjson is not visible in map_item/frontend
+					original_item[field] = val
 
 			yield original_item
 
-			if post_count % 2500 == 0:
+			if time.monotonic() - last_update >= self.status_interval:
 				self.dataset.update_status("Processed %i posts" % post_count)
 				self.dataset.update_progress(post_count / self.source_dataset.num_rows)
+				last_update = time.monotonic()